@@ -1,8 +1,10 @@
 import os
 import json
+import heapq
+import functools
 import time
 import threading
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from urllib.parse import quote_plus
 from dotenv import load_dotenv
 from flask import Flask
@@ -28,19 +30,53 @@ PUBLIC_CHANNEL_ID = os.getenv('PUBLIC_CHANNEL_ID')
 PUBLIC_CHANNEL_LINK = os.getenv('PUBLIC_CHANNEL_LINK')
 FIREBASE_KEY_STR = os.getenv('FIREBASE_KEY')
 
-bot = telebot.TeleBot(BOT_TOKEN, parse_mode='HTML')
+# num_threads raised from the default of 2 so slow Firestore round-trips in
+# one handler don't stall every other user's update.
+bot = telebot.TeleBot(BOT_TOKEN, parse_mode='HTML', num_threads=8)
+
+# Recycle the per-thread requests.Session every 5 minutes: keeps Bot API
+# connections warm (no TLS handshake per call) while avoiding stale
+# keep-alive sockets after long idle periods.
+telebot.apihelper.SESSION_TIME_TO_LIVE = 5 * 60
+
+# Explicit Bot API timeouts: with only 8 worker threads, one hung HTTPS
+# call on a lenient default timeout can hold a thread (and every update
+# queued behind it) for far longer than any healthy request needs.
+telebot.apihelper.CONNECT_TIMEOUT = 10
+telebot.apihelper.READ_TIMEOUT = 30
 
 # ==========================================
-# 2. FIREBASE INITIALIZATION
+# 2. FIREBASE INITIALIZATION (LAZY)
 # ==========================================
-try:
-    firebase_cred_dict = json.loads(FIREBASE_KEY_STR)
-    cred = credentials.Certificate(firebase_cred_dict)
-    firebase_admin.initialize_app(cred)
-    db = firestore.client()
-    print("Firebase initialized successfully.")
-except Exception as e:
-    print(f"Error initializing Firebase: {e}")
+_db = None
+_db_lock = threading.Lock()
+
+def get_db():
+    """Initialize Firebase on first use (thread-safe) and return the client.
+
+    Keeps credential parsing and the network handshake off import time so
+    reloads and tooling that import this module stay fast.
+    """
+    global _db
+    if _db is None:
+        with _db_lock:
+            if _db is None:
+                firebase_cred_dict = json.loads(FIREBASE_KEY_STR)
+                cred = credentials.Certificate(firebase_cred_dict)
+                firebase_admin.initialize_app(cred)
+                _db = firestore.client()
+                print("Firebase initialized successfully.")
+    return _db
+
+@functools.lru_cache(maxsize=None)
+def users_col():
+    """Cached handle for the users collection (built once per process)."""
+    return get_db().collection('users')
+
+@functools.lru_cache(maxsize=4096)
+def user_ref(user_id):
+    """Cached DocumentReference for a user (refs are immutable handles)."""
+    return users_col().document(str(user_id))
 
 # ==========================================
 # 3. GLOBAL CACHE & STATE MANAGEMENT
@@ -51,6 +87,7 @@ CACHE = {
     'exams': {},             # {exam_id: questions_list}
     'exam_lists': {},        # {category_subject: [exam_types]}
     'ads': [],        
+    'keyboards': {},         # {cache key: prebuilt ReplyKeyboardMarkup}
     'total_users': 0
 }
 
@@ -70,7 +107,10 @@ def home():
     return "Bot is alive and running!"
 
 def run_flask():
-    app.run(host="0.0.0.0", port=int(os.environ.get('PORT', 8080)))
+    # threaded=True so overlapping platform health checks don't queue behind
+    # each other; the reloader must stay off inside a daemon thread.
+    app.run(host="0.0.0.0", port=int(os.environ.get('PORT', 8080)),
+            threaded=True, debug=False, use_reloader=False)
 
 # ==========================================
 # 5. HELPER FUNCTIONS
@@ -80,7 +120,7 @@ def load_cache():
     global CACHE
     try:
         # --- NEW AD LOADING LOGIC ---
-        ad_doc = db.collection('settings').document('advertisement').get()
+        ad_doc = get_db().collection('settings').document('advertisement').get()
         if ad_doc.exists:
             data = ad_doc.to_dict()
             if 'ads' in data:
@@ -91,28 +131,53 @@ def load_cache():
                 CACHE['ads'] = [{"chat_id": data['chat_id'], "message_id": data['message_id']}]
             else:
                 CACHE['ads'] = []
+        else:
+            # Settings doc removed entirely: don't keep serving stale ads.
+            CACHE['ads'] = []
         # -----------------------------
         
-        # Load Entrance
-        ent_ref = db.collection('exam').document('entrance').collection('subjects').stream()
+        # Load Entrance (rebuild from scratch so renamed/removed subjects
+        # don't linger from a previous load)
+        entrance_subjects = {}
+        ent_ref = get_db().collection('exam').document('entrance').collection('subjects').stream()
         for doc in ent_ref:
-            CACHE['entrance_subjects'][doc.to_dict().get('name', doc.id)] = doc.id
-            
+            entrance_subjects[doc.to_dict().get('name', doc.id)] = doc.id
+        CACHE['entrance_subjects'] = entrance_subjects
+
         # Load Exit
-        ext_ref = db.collection('exam').document('exit').collection('departments').stream()
+        exit_departments = {}
+        ext_ref = get_db().collection('exam').document('exit').collection('departments').stream()
         for doc in ext_ref:
-            CACHE['exit_departments'][doc.to_dict().get('name', doc.id)] = doc.id
+            exit_departments[doc.to_dict().get('name', doc.id)] = doc.id
+        CACHE['exit_departments'] = exit_departments
+
+        # Prebuilt keyboards follow the subject/department lists
+        CACHE['keyboards'] = {}
             
-        # Load User Count
-        users = db.collection('users').count().get()
-        CACHE['total_users'] = users[0][0].value
+        # Load User Count (server-side aggregation; result shape is SDK
+        # specific, so keep a failure here from aborting the whole reload)
+        try:
+            users = users_col().count().get()
+            CACHE['total_users'] = users[0][0].value
+        except Exception as e:
+            print(f"User count load error: {e}")
     except Exception as e:
         print(f"Cache load error: {e}")
 
+# Positive membership results are cached for 15 minutes so repeat /start and
+# navigation taps don't burn a get_chat_member call against the Bot API limit.
+_member_cache = {}  # {user_id: expiry_timestamp}
+MEMBER_CACHE_TTL = 15 * 60
+
 def check_membership(user_id):
+    if _member_cache.get(user_id, 0) > time.time():
+        return True
     try:
         member = bot.get_chat_member(PUBLIC_CHANNEL_ID, user_id)
-        return member.status in ['member', 'administrator', 'creator']
+        if member.status in ['member', 'administrator', 'creator']:
+            _member_cache[user_id] = time.time() + MEMBER_CACHE_TTL
+            return True
+        return False
     except Exception:
         return False
 
@@ -142,10 +207,31 @@ def build_reply_keyboard(buttons_text, cols=2, add_nav=False):
         markup.add(KeyboardButton("Back"), KeyboardButton("Home"))
     return markup
 
-def register_user(user_id, username):
-    doc_ref = db.collection('users').document(str(user_id))
-    if not doc_ref.get().exists:
-        doc_ref.set({"username": username, "joined_at": datetime.now(), "referrals": 0})
+# The main menu never changes; build its keyboard once and reuse it for
+# every render instead of re-allocating button objects per user.
+MAIN_MENU_MARKUP = build_reply_keyboard(["Entrance Exam", "Exit Exam", "Score"], cols=2)
+
+def admin_only(fn):
+    """Drop updates from anyone but the admin before the handler body runs.
+
+    Works for both message and callback handlers since each carries
+    from_user.
+    """
+    @functools.wraps(fn)
+    def wrapper(update, *args, **kwargs):
+        if update.from_user.id != ADMIN_TELEGRAM_ID:
+            return
+        return fn(update, *args, **kwargs)
+    return wrapper
+
+def register_user(user_id, username, already_registered=None):
+    """Create the user doc if needed. Callers that have already fetched the
+    doc can pass already_registered to skip the extra existence read."""
+    doc_ref = user_ref(user_id)
+    if already_registered is None:
+        already_registered = doc_ref.get().exists
+    if not already_registered:
+        doc_ref.set({"username": username, "joined_at": firestore.SERVER_TIMESTAMP, "referrals": 0})
         CACHE['total_users'] += 1
 
 def update_activity(user_id):
@@ -206,12 +292,14 @@ def maintenance_check(message):
 @bot.message_handler(commands=['start'])
 def send_welcome(message):
     user_id = message.from_user.id
-    user_doc_ref = db.collection('users').document(str(user_id))
+    user_doc_ref = user_ref(user_id)
     try:
         user_doc = user_doc_ref.get()
         user_already_registered = user_doc.exists
     except Exception:
-        user_already_registered = False
+        # Unknown state; let register_user re-check rather than risking an
+        # overwrite of an existing doc.
+        user_already_registered = None
 
     args = message.text.split()
     if not user_already_registered and len(args) > 1 and args[1].startswith("ref_"):
@@ -224,25 +312,44 @@ def send_welcome(message):
                 ref_user_id = None
 
             if ref_user_id and ref_user_id != user_id:
+                inviter_ref = user_ref(ref_user_id)
+
+                # Read the inviter once, before the write: the post-commit
+                # totals are just this snapshot plus the increments below,
+                # so no second read is needed to check the unlock threshold.
+                try:
+                    inviter_doc = inviter_ref.get()
+                    inviter_data = (inviter_doc.to_dict() or {}) if inviter_doc.exists else {}
+                except Exception:
+                    inviter_data = {}
+                count_for_exam = (inviter_data.get('referrals_map') or {}).get(exam_id, 0) + 1
+                unlocked = inviter_data.get('unlocked_exams') or []
+                unlock_now = count_for_exam >= 4 and exam_id not in unlocked
+
                 try:
-                    db.collection('referrals').add({
+                    # Record the referral and bump the inviter's counters in
+                    # one batched commit instead of two sequential writes.
+                    batch = get_db().batch()
+                    batch.set(get_db().collection('referrals').document(), {
                         'inviter_id': ref_user_id,
                         'invited_id': user_id,
                         'exam_id': exam_id,
-                        'timestamp': datetime.utcnow()
+                        'timestamp': firestore.SERVER_TIMESTAMP
                     })
-                except Exception:
-                    pass
-
-                try:
-                    inviter_ref = db.collection('users').document(str(ref_user_id))
-                    inviter_ref.update({
-                        f"referrals_map.{exam_id}": firestore.Increment(1),
+                    batch.set(inviter_ref, {
+                        "referrals_map": {exam_id: firestore.Increment(1)},
                         "referrals": firestore.Increment(1)
-                    })
+                    }, merge=True)
+                    if unlock_now:
+                        # The threshold was reached by this referral; the
+                        # unlock rides in the same commit as the counters.
+                        batch.set(inviter_ref, {
+                            'unlocked_exams': firestore.ArrayUnion([exam_id])
+                        }, merge=True)
+                    batch.commit()
                 except Exception:
                     try:
-                        db.collection('users').document(str(ref_user_id)).update({"referrals": firestore.Increment(1)})
+                        inviter_ref.update({"referrals": firestore.Increment(1)})
                     except Exception:
                         pass
 
@@ -251,20 +358,7 @@ def send_welcome(message):
                     active_sessions[ref_user_id]['referrals'] += 1
 
                 try:
-                    inviter_doc = db.collection('users').document(str(ref_user_id)).get()
-                    inviter_data = inviter_doc.to_dict() if inviter_doc.exists else {}
-                    referrals_map = inviter_data.get('referrals_map', {}) if inviter_data else {}
-                    count_for_exam = referrals_map.get(exam_id, 0)
-                    unlocked = inviter_data.get('unlocked_exams', []) if inviter_data else []
-
-                    if count_for_exam >= 4 and exam_id not in unlocked:
-                        try:
-                            db.collection('users').document(str(ref_user_id)).update({
-                                'unlocked_exams': firestore.ArrayUnion([exam_id])
-                            })
-                        except Exception:
-                            pass
-
+                    if unlock_now:
                         if ref_user_id in active_sessions and active_sessions[ref_user_id].get('exam_id') == exam_id:
                             active_sessions[ref_user_id]['locked'] = False
                             try:
@@ -281,7 +375,17 @@ def send_welcome(message):
                 except Exception:
                     pass
 
-    register_user(user_id, message.from_user.username)
+    if user_already_registered:
+        # Returning user: refresh the stored username with a single merge
+        # write, and only when it actually changed — no extra reads.
+        stored_username = (user_doc.to_dict() or {}).get('username')
+        if stored_username != message.from_user.username:
+            try:
+                user_doc_ref.set({"username": message.from_user.username}, merge=True)
+            except Exception:
+                pass
+    else:
+        register_user(user_id, message.from_user.username, user_already_registered)
 
     if not check_membership(user_id):
         markup = InlineKeyboardMarkup()
@@ -316,10 +420,15 @@ def verify_membership_callback(call):
 
 def show_main_menu(user_id):
     user_states[user_id] = {"menu": "main"}
-    markup = build_reply_keyboard(["Entrance Exam", "Exit Exam", "Score"], cols=2)
-    bot.send_message(user_id, "Welcome! Please select a category:", reply_markup=markup)
+    bot.send_message(user_id, "Welcome! Please select a category:", reply_markup=MAIN_MENU_MARKUP)
+
+# Filter lambdas run for every incoming update, so their constant button
+# sets are hoisted to module level instead of rebuilt per call.
+NAV_BUTTONS = frozenset(("Entrance Exam", "Exit Exam", "Home", "Back"))
+NAV_CONFIRM_CALLBACKS = frozenset(("confirm_home", "confirm_back", "cancel_nav"))
+ADMIN_MISC_CALLBACKS = frozenset(("cache_yes", "cache_cancel", "toggle_maintenance"))
 
-@bot.message_handler(func=lambda msg: msg.text in ["Entrance Exam", "Exit Exam", "Home", "Back"])
+@bot.message_handler(func=lambda msg: msg.text in NAV_BUTTONS)
 def navigation_handler(message):
     user_id = message.from_user.id
     text = message.text
@@ -341,7 +450,7 @@ def navigation_handler(message):
 def show_cumulative_score(message):
     user_id = message.from_user.id
     try:
-        doc = db.collection('users').document(str(user_id)).get()
+        doc = user_ref(user_id).get(field_paths=['total_attempts', 'total_correct'])
         data = doc.to_dict() if doc.exists else {}
         total_attempts = data.get('total_attempts', 0)
         total_correct = data.get('total_correct', 0)
@@ -360,14 +469,18 @@ def handle_navigation_action(user_id, action):
         
     if action == "Entrance":
         user_states[user_id] = {"menu": "entrance_subjects"}
-        subjects = list(CACHE['entrance_subjects'].keys())
-        markup = build_reply_keyboard(subjects, cols=2, add_nav=True)
+        markup = CACHE['keyboards'].get('entrance')
+        if markup is None:
+            markup = build_reply_keyboard(list(CACHE['entrance_subjects'].keys()), cols=2, add_nav=True)
+            CACHE['keyboards']['entrance'] = markup
         bot.send_message(user_id, "Select a Subject:", reply_markup=markup)
         
     elif action == "Exit":
         user_states[user_id] = {"menu": "exit_departments"}
-        departments = list(CACHE['exit_departments'].keys())
-        markup = build_reply_keyboard(departments, cols=2, add_nav=True)
+        markup = CACHE['keyboards'].get('exit')
+        if markup is None:
+            markup = build_reply_keyboard(list(CACHE['exit_departments'].keys()), cols=2, add_nav=True)
+            CACHE['keyboards']['exit'] = markup
         bot.send_message(user_id, "Select a Department:", reply_markup=markup)
         
     elif action == "Back":
@@ -377,7 +490,7 @@ def handle_navigation_action(user_id, action):
             category = state.get("category", "Entrance")
             handle_navigation_action(user_id, category)
 
-@bot.callback_query_handler(func=lambda call: call.data in ["confirm_home", "confirm_back", "cancel_nav"])
+@bot.callback_query_handler(func=lambda call: call.data in NAV_CONFIRM_CALLBACKS)
 def nav_confirmation(call):
     user_id = call.from_user.id
     bot.delete_message(call.message.chat.id, call.message.message_id)
@@ -394,7 +507,7 @@ def nav_confirmation(call):
         except Exception:
             pass
 
-        save_session_progress(user_id)
+        save_session_progress_async(user_id)
         del active_sessions[user_id]
         
     if call.data == "confirm_home":
@@ -430,9 +543,9 @@ def item_selection_handler(message):
     if cache_key not in CACHE['exam_lists']:
         try:
             if category == "Entrance":
-                exams_ref = db.collection('exam').document('entrance').collection('subjects').document(item_code).collection('exams').stream()
+                exams_ref = get_db().collection('exam').document('entrance').collection('subjects').document(item_code).collection('exams').stream()
             else:
-                exams_ref = db.collection('exam').document('exit').collection('departments').document(item_code).collection('exams').stream()
+                exams_ref = get_db().collection('exam').document('exit').collection('departments').document(item_code).collection('exams').stream()
             
             exam_types = []
             for doc in exams_ref:
@@ -473,15 +586,22 @@ def start_exam(message):
         bot.send_message(user_id, "Loading exam...")
         try:
             if category == "Entrance":
-                query = db.collection('exam').document('entrance').collection('subjects').document(item_code).collection('exams').where('typeName', '==', exam_type).limit(1).stream()
+                exams_col = get_db().collection('exam').document('entrance').collection('subjects').document(item_code).collection('exams')
             else:
-                query = db.collection('exam').document('exit').collection('departments').document(item_code).collection('exams').where('typeName', '==', exam_type).limit(1).stream()
-            
+                exams_col = get_db().collection('exam').document('exit').collection('departments').document(item_code).collection('exams')
+
+            # New uploads use the type name as the document ID, so a single
+            # point read is enough. Older exams were added with auto IDs, so
+            # fall back to the typeName query for those.
             questions = []
-            for doc in query:
-                questions = doc.to_dict().get('questions', [])
-                break
-            
+            snap = exams_col.document(exam_type).get()
+            if snap.exists:
+                questions = snap.to_dict().get('questions', [])
+            else:
+                for doc in exams_col.where('typeName', '==', exam_type).limit(1).stream():
+                    questions = doc.to_dict().get('questions', [])
+                    break
+
             if not questions:
                 bot.send_message(user_id, "No questions found for this exam.")
                 return
@@ -645,11 +765,9 @@ def receive_screenshot(message):
     # Reset State safely
     user_states[user_id]["menu"] = "main"
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("approve_") or call.data.startswith("reject_"))
+@bot.callback_query_handler(func=lambda call: (call.data.startswith("approve_") or call.data.startswith("reject_")) and call.from_user.id == ADMIN_TELEGRAM_ID)
+@admin_only
 def admin_payment_action(call):
-    if call.from_user.id != ADMIN_TELEGRAM_ID:
-        return
-
     parts = call.data.split("_")
     action = parts[0]
     target_user_id = int(parts[1])
@@ -669,12 +787,12 @@ def admin_payment_action(call):
     tcode = parts[3]
 
     try:
-        user_ref = db.collection('users').document(str(target_user_id))
+        target_ref = user_ref(target_user_id)
         if ptype == "entrance":
-            user_ref.set({"premium_entrance": True}, merge=True)
+            target_ref.set({"premium_entrance": True}, merge=True)
             target_name = "Entrance Exams (All Subjects)"
         else:
-            user_ref.set({"premium_exit": firestore.ArrayUnion([tcode])}, merge=True)
+            target_ref.set({"premium_exit": firestore.ArrayUnion([tcode])}, merge=True)
             target_name = next((name for name, c in CACHE.get('exit_departments', {}).items() if c == tcode), tcode)
             target_name = f"Exit Exam ({target_name})"
 
@@ -705,6 +823,27 @@ def admin_payment_action(call):
 # ==========================================
 # 9. QUIZ INTERFACE & LOGIC
 # ==========================================
+# Rendered question blocks are identical for every user taking the same
+# exam, so build each one once and share it; entries are dropped when the
+# exam is re-uploaded or the cache is cleared.
+_rendered_questions = {}  # {(exam_id, index): html text}
+
+def render_question(session):
+    key = (session.get('exam_id'), session['current_index'])
+    text = _rendered_questions.get(key)
+    if text is None:
+        q_data = session['questions'][session['current_index']]
+        total_q = len(session['questions'])
+        text = (f"<b>{safe_html(session['title'])}</b>\n\n"
+                f"Question {session['current_index'] + 1} / {total_q}\n\n"
+                f"{safe_html(q_data.get('question_text',''))}\n\n"
+                f"A. {safe_html(q_data.get('options',{}).get('a',''))}\n"
+                f"B. {safe_html(q_data.get('options',{}).get('b',''))}\n"
+                f"C. {safe_html(q_data.get('options',{}).get('c',''))}\n"
+                f"D. {safe_html(q_data.get('options',{}).get('d',''))}")
+        _rendered_questions[key] = text
+    return text
+
 def send_question(user_id, edit_msg_id=None):
     session = active_sessions.get(user_id)
     if not session:
@@ -716,7 +855,10 @@ def send_question(user_id, edit_msg_id=None):
         category = exam_id.split("_")[0].lower() if "_" in exam_id else ""
         
         try:
-            user_doc = db.collection('users').document(str(user_id)).get()
+            # Project down to the access-control fields; the user doc also
+            # carries referral maps and profile data this check never uses.
+            user_doc = user_ref(user_id).get(
+                field_paths=['unlocked_exams', 'premium_entrance', 'premium_exit'])
             user_data = user_doc.to_dict() if user_doc.exists else {}
             unlocked = user_data.get('unlocked_exams', []) if user_data else []
 
@@ -799,21 +941,17 @@ def send_question(user_id, edit_msg_id=None):
         show_advertisement(user_id, last_question_msg_id=last_q_msg_id)
         return
 
-    q_data = session['questions'][session['current_index']]
-    total_q = len(session['questions'])
-    text = (f"<b>{safe_html(session['title'])}</b>\n\n"
-            f"Question {session['current_index'] + 1} / {total_q}\n\n"
-            f"{safe_html(q_data.get('question_text',''))}\n\n"
-            f"A. {safe_html(q_data.get('options',{}).get('a',''))}\n"
-            f"B. {safe_html(q_data.get('options',{}).get('b',''))}\n"
-            f"C. {safe_html(q_data.get('options',{}).get('c',''))}\n"
-            f"D. {safe_html(q_data.get('options',{}).get('d',''))}")
-            
+    text = render_question(session)
+
+    # Keep the rendered block around so handle_answer can append the result
+    # without re-escaping and re-formatting the same strings.
+    session['last_q_text'] = text
+
     markup = build_inline_keyboard([
         ("A", "ans_a"), ("B", "ans_b"),
         ("C", "ans_c"), ("D", "ans_d")
     ], cols=2)
-    
+
     try:
         if edit_msg_id:
             bot.edit_message_text(text, user_id, edit_msg_id, reply_markup=markup)
@@ -845,14 +983,9 @@ def handle_answer(call):
     else:
         result_icon = "✗ Incorrect"
         
-    total_q = len(session['questions'])
-    text = (f"<b>{safe_html(session['title'])}</b>\n\n"
-            f"Question {session['current_index'] + 1} / {total_q}\n\n"
-            f"{safe_html(q_data.get('question_text',''))}\n\n"
-            f"A. {safe_html(q_data.get('options',{}).get('a',''))}\n"
-            f"B. {safe_html(q_data.get('options',{}).get('b',''))}\n"
-            f"C. {safe_html(q_data.get('options',{}).get('c',''))}\n"
-            f"D. {safe_html(q_data.get('options',{}).get('d',''))}\n\n"
+    original_text = session.get('last_q_text') or render_question(session)
+
+    text = (f"{original_text}\n\n"
             f"<b>{result_icon}</b>\n"
             f"Correct Answer: {safe_html(correct_ans.upper())}\n\n"
             f"Explanation:\n{safe_html(q_data.get('explanation', 'No explanation provided.'))}")
@@ -867,6 +1000,10 @@ def next_question_callback(call):
     update_activity(user_id)
     if user_id in active_sessions:
         active_sessions[user_id]['current_index'] += 1
+        # Checkpoint cumulative stats every 10 questions so progress is not
+        # lost if the process dies mid-session.
+        if active_sessions[user_id]['current_index'] % 10 == 0:
+            save_session_progress(user_id)
         send_question(user_id, call.message.message_id)
     else:
         bot.answer_callback_query(call.id, "Session expired.")
@@ -888,7 +1025,8 @@ def check_referral_callback(call):
             
         # Check their global premium status
         try:
-            user_doc = db.collection('users').document(str(user_id)).get()
+            user_doc = user_ref(user_id).get(
+                field_paths=['premium_entrance', 'premium_exit'])
             user_data = user_doc.to_dict() if user_doc.exists else {}
             is_premium = user_data.get("premium_entrance") == True or len(user_data.get("premium_exit", [])) > 0
             
@@ -908,7 +1046,8 @@ def check_referral_callback(call):
     is_premium = False 
     
     try:
-        inviter_doc = db.collection('users').document(str(user_id)).get()
+        inviter_doc = user_ref(user_id).get(
+            field_paths=['referrals_map', 'unlocked_exams', 'premium_entrance', 'premium_exit'])
         inviter_data = inviter_doc.to_dict() if inviter_doc.exists else {}
         referrals_map = inviter_data.get('referrals_map', {}) if inviter_data else {}
         count_for_exam = referrals_map.get(exam_id, 0)
@@ -933,7 +1072,7 @@ def check_referral_callback(call):
         
         if count_for_exam >= 4 and exam_id not in unlocked:
             try:
-                db.collection('users').document(str(user_id)).update({
+                user_ref(user_id).update({
                     'unlocked_exams': firestore.ArrayUnion([exam_id])
                 })
             except Exception:
@@ -1036,45 +1175,59 @@ def show_advertisement(user_id, last_question_msg_id=None):
 
     threading.Thread(target=run_countdown, args=(user_id, countdown_msg_id), daemon=True).start()
 
-def save_session_progress(user_id):
-    session = active_sessions.get(user_id)
+def save_session_progress(user_id, session=None):
+    session = session or active_sessions.get(user_id)
     if not session:
         return
     try:
-        score = session['correct']
-        attempts = session['current_index']
+        # Only write the delta since the last checkpoint so this can be
+        # called repeatedly during a session without double-counting.
+        score = session['correct'] - session.get('saved_correct', 0)
+        attempts = session['current_index'] - session.get('saved_attempts', 0)
         if attempts > 0:
-            doc_ref = db.collection('users').document(str(user_id))
+            doc_ref = user_ref(user_id)
             doc_ref.set({
                 "total_correct": firestore.Increment(score),
                 "total_attempts": firestore.Increment(attempts),
                 "completed_exams": firestore.ArrayUnion([session['exam_id']]),
             }, merge=True)
+            session['saved_correct'] = session['correct']
+            session['saved_attempts'] = session['current_index']
     except Exception as e:
         print(f"Error saving progress: {e}")
 
+def save_session_progress_async(user_id):
+    """Persist final progress in a background thread.
+
+    The user doesn't need to wait for the stats write, so callers that are
+    about to drop the session can hand the dict off and reply immediately.
+    """
+    session = active_sessions.get(user_id)
+    if not session:
+        return
+    threading.Thread(target=save_session_progress, args=(user_id, session), daemon=True).start()
+
 def end_exam(user_id, msg_id):
     session = active_sessions.get(user_id)
     score = session['correct']
     total = len(session['questions'])
     bot.edit_message_text(f"🏁 <b>Exam Completed!</b>\n\nYour Score: {score} / {total}", user_id, msg_id)
-    save_session_progress(user_id)
+    save_session_progress_async(user_id)
     del active_sessions[user_id]
     handle_navigation_action(user_id, "Home")
 
 # ==========================================
 # 10. ADMIN PANEL & COMMANDS
 # ==========================================
-@bot.message_handler(commands=['ethioegzam'])
+@bot.message_handler(commands=['ethioegzam'], func=lambda msg: msg.from_user.id == ADMIN_TELEGRAM_ID)
+@admin_only
 def admin_panel(message):
-    if message.from_user.id != ADMIN_TELEGRAM_ID:
-        return
-        
     markup = build_inline_keyboard([
         ("Add Field", "admin_add_field"),
         ("Add Quiz", "admin_add_quiz"),
         ("Add Ad", "admin_add_ad"),
         ("Total User", "admin_total_user"),
+        ("Leaderboard", "admin_leaderboard"),
         ("Broadcast", "admin_broadcast"),
         ("Clear Cache", "admin_clear_cache"),
         ("Maintenance", "admin_maintenance")
@@ -1082,11 +1235,9 @@ def admin_panel(message):
     
     bot.send_message(message.from_user.id, "🛠 <b>Welcome! Admin Panel</b>", reply_markup=markup)
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("admin_"))
+@bot.callback_query_handler(func=lambda call: call.data.startswith("admin_") and call.from_user.id == ADMIN_TELEGRAM_ID)
+@admin_only
 def admin_callbacks(call):
-    if call.from_user.id != ADMIN_TELEGRAM_ID:
-        return
-        
     action = call.data
     bot.answer_callback_query(call.id)
     
@@ -1105,6 +1256,11 @@ def admin_callbacks(call):
     elif action == "admin_total_user":
         bot.send_message(call.from_user.id, f"Total registered users: {CACHE['total_users']}")
         
+    elif action == "admin_leaderboard":
+        # The scan can take a while on a large user base; run it off the
+        # handler pool so other users' updates aren't queued behind it.
+        threading.Thread(target=show_admin_leaderboard, args=(call.from_user.id,), daemon=True).start()
+
     elif action == "admin_broadcast":
         msg = bot.send_message(call.from_user.id, "Send text message OR photo/video with caption for broadcast.")
         bot.register_next_step_handler(msg, process_broadcast)
@@ -1119,6 +1275,86 @@ def admin_callbacks(call):
         markup = build_inline_keyboard([(status, "toggle_maintenance")], cols=1)
         bot.send_message(call.from_user.id, f"Maintenance Mode is currently {'ON' if MAINTENANCE_MODE else 'OFF'}", reply_markup=markup)
 
+# The ranking is identical between admin clicks seconds apart; keep the
+# computed board for a minute so repeat invocations skip the collection scan.
+_leaderboard_cache = {'t': 0, 'top': None}
+LEADERBOARD_CACHE_TTL = 60
+
+def build_leaderboard():
+    """Rank users by cumulative accuracy.
+
+    Names and stats live on the same user documents, so the whole board is
+    built from a single collection stream — no per-user follow-up reads.
+    """
+    if time.monotonic() - _leaderboard_cache['t'] < LEADERBOARD_CACHE_TTL and _leaderboard_cache['top'] is not None:
+        return _leaderboard_cache['top']
+
+    if _leaderboard_cache['top'] is None:
+        # Cold start (fresh process): a recent snapshot doc is one read
+        # versus streaming every user, so prefer it when fresh enough.
+        try:
+            snap = get_db().collection('settings').document('leaderboard').get()
+            if snap.exists:
+                data = snap.to_dict() or {}
+                updated_at = data.get('updated_at')
+                if updated_at and datetime.now(timezone.utc) - updated_at < timedelta(minutes=10):
+                    top = [(e['name'], e['accuracy'], e['attempts']) for e in data.get('top', [])]
+                    _leaderboard_cache['top'] = top
+                    _leaderboard_cache['t'] = time.monotonic()
+                    return top
+        except Exception as e:
+            print(f"Leaderboard snapshot load error: {e}")
+
+    entries = []  # [(display_name, accuracy, attempts)]
+    # Users without any recorded attempts can't rank; filter them
+    # server-side so idle accounts are never streamed at all, and project
+    # down to the three fields the ranking actually uses.
+    docs = (users_col()
+            .where('total_attempts', '>', 0)
+            .select(['username', 'total_attempts', 'total_correct'])
+            .stream())
+    entries_append = entries.append  # pre-bound: this loop runs once per user
+    for doc in docs:
+        data = doc.to_dict() or {}
+        attempts = data.get('total_attempts', 0)
+        if not attempts:
+            continue
+        entries_append((data.get('username') or doc.id,
+                        data.get('total_correct', 0) / attempts,
+                        attempts))
+    # Only the top 10 are ever shown; nlargest is O(N log 10) versus a
+    # full O(N log N) sort of the whole user base.
+    top = heapq.nlargest(10, entries, key=lambda x: x[1])
+
+    # Persist the snapshot so the next cold start can serve it with a
+    # single doc read instead of a full scan.
+    try:
+        get_db().collection('settings').document('leaderboard').set({
+            'top': [{'name': n, 'accuracy': a, 'attempts': att} for n, a, att in top],
+            'updated_at': firestore.SERVER_TIMESTAMP
+        })
+    except Exception as e:
+        print(f"Leaderboard snapshot save error: {e}")
+
+    _leaderboard_cache['top'] = top
+    _leaderboard_cache['t'] = time.monotonic()
+    return top
+
+def show_admin_leaderboard(chat_id):
+    try:
+        top = build_leaderboard()
+    except Exception as e:
+        bot.send_message(chat_id, f"Error building leaderboard: {e}")
+        return
+
+    if not top:
+        bot.send_message(chat_id, "No user activity recorded yet.")
+        return
+
+    rows = "\n".join(f"{i}. {safe_html(name)} — {acc * 100:.1f}% ({attempts} attempts)"
+                     for i, (name, acc, attempts) in enumerate(top, 1))
+    bot.send_message(chat_id, f"🏆 <b>Top Users</b>\n\n{rows}")
+
 def process_add_field(message):
     if message.text == "/cancel":
         bot.send_message(message.from_user.id, "Operation cancelled.")
@@ -1132,16 +1368,36 @@ def process_add_field(message):
         else:
             data = json.loads(message.text)
             
+        # Commit all field docs in batches (well under Firestore's 500-op
+        # limit) instead of one RPC per document.
+        batch = get_db().batch()
+        ops = 0
+
         if 'entrance' in data and 'subjects' in data['entrance']:
+            # Resolve the collection once; building the exam/entrance/...
+            # reference chain per subject is pure repeated allocation.
+            subjects_ref = get_db().collection('exam').document('entrance').collection('subjects')
             for sub in data['entrance']['subjects']:
                 code = sub.get('code', sub['name'].lower().replace(' ', '_'))
-                db.collection('exam').document('entrance').collection('subjects').document(code).set(sub)
-                
+                batch.set(subjects_ref.document(code), sub)
+                ops += 1
+                if ops % 450 == 0:
+                    batch.commit()
+                    batch = get_db().batch()
+
         if 'exit' in data and 'departments' in data['exit']:
+            departments_ref = get_db().collection('exam').document('exit').collection('departments')
             for dept in data['exit']['departments']:
                 code = dept.get('code', dept['name'].lower().replace(' ', '_'))
-                db.collection('exam').document('exit').collection('departments').document(code).set(dept)
-                
+                batch.set(departments_ref.document(code), dept)
+                ops += 1
+                if ops % 450 == 0:
+                    batch.commit()
+                    batch = get_db().batch()
+
+        if ops % 450:
+            batch.commit()
+
         bot.send_message(message.from_user.id, "Fields successfully added.")
         load_cache() 
     except Exception as e:
@@ -1173,6 +1429,27 @@ def process_quiz_type(message, cat, code):
     msg = bot.send_message(message.from_user.id, "Upload the quiz questions JSON file.")
     bot.register_next_step_handler(msg, process_quiz_upload, cat, code, type_name)
 
+def validate_quiz_questions(questions):
+    """Check an uploaded question list before it is written.
+
+    Returns an error string naming the first bad entry, or None if the
+    payload is usable. Catching this up front means a malformed file is
+    rejected whole instead of being saved and failing mid-exam.
+    """
+    if not isinstance(questions, list) or not questions:
+        return "Expected a non-empty JSON array of questions."
+    for i, q in enumerate(questions, start=1):
+        if not isinstance(q, dict):
+            return f"Question {i} is not an object."
+        if not q.get('question_text'):
+            return f"Question {i} is missing 'question_text'."
+        options = q.get('options')
+        if not isinstance(options, dict) or not all(options.get(o) for o in ('a', 'b', 'c', 'd')):
+            return f"Question {i} must have options a-d."
+        if str(q.get('answer', '')).lower() not in ('a', 'b', 'c', 'd'):
+            return f"Question {i} has an invalid 'answer' (expected a-d)."
+    return None
+
 def process_quiz_upload(message, cat, code, type_name):
     try:
         if not message.document:
@@ -1182,18 +1459,31 @@ def process_quiz_upload(message, cat, code, type_name):
         file_info = bot.get_file(message.document.file_id)
         downloaded_file = bot.download_file(file_info.file_path)
         questions = json.loads(downloaded_file)
+
+        error = validate_quiz_questions(questions)
+        if error:
+            bot.send_message(message.from_user.id, f"Upload rejected: {error} Nothing was saved.")
+            return
         
         doc_data = {"typeName": type_name, "questions": questions}
-        
+
+        # Use the type name as the document ID so exams can be fetched with a
+        # direct point read instead of an indexed query.
         if cat == "entrance":
-            db.collection('exam').document('entrance').collection('subjects').document(code).collection('exams').add(doc_data)
+            get_db().collection('exam').document('entrance').collection('subjects').document(code).collection('exams').document(type_name).set(doc_data)
         else:
-            db.collection('exam').document('exit').collection('departments').document(code).collection('exams').add(doc_data)
-            
+            get_db().collection('exam').document('exit').collection('departments').document(code).collection('exams').document(type_name).set(doc_data)
+
         bot.send_message(message.from_user.id, "Quiz successfully uploaded and saved.")
         cache_key = f"{cat.capitalize()}_{code}"
         if cache_key in CACHE['exam_lists']:
             del CACHE['exam_lists'][cache_key]
+        # Drop any cached copy of this exam so a re-upload takes effect
+        # without a full cache clear.
+        exam_id = f"{cache_key}_{type_name}"
+        CACHE['exams'].pop(exam_id, None)
+        for key in [k for k in _rendered_questions if k[0] == exam_id]:
+            del _rendered_questions[key]
     except Exception as e:
         bot.send_message(message.from_user.id, f"Error saving quiz: {e}")
 
@@ -1202,7 +1492,7 @@ def process_add_ad(message):
         new_ad = {"chat_id": message.chat.id, "message_id": message.message_id}
         
         # 1. Append to Firestore using ArrayUnion
-        db.collection('settings').document('advertisement').set({
+        get_db().collection('settings').document('advertisement').set({
             "ads": firestore.ArrayUnion([new_ad])
         }, merge=True)
         
@@ -1215,7 +1505,8 @@ def process_add_ad(message):
     except Exception as e:
         bot.send_message(message.from_user.id, f"Error saving Ad: {e}")
 
-@bot.callback_query_handler(func=lambda call: call.data in ["cache_yes", "cache_cancel", "toggle_maintenance"])
+@bot.callback_query_handler(func=lambda call: call.data in ADMIN_MISC_CALLBACKS and call.from_user.id == ADMIN_TELEGRAM_ID)
+@admin_only
 def admin_misc_callbacks(call):
     if call.data == "cache_cancel":
         bot.delete_message(call.message.chat.id, call.message.message_id)
@@ -1226,6 +1517,7 @@ def admin_misc_callbacks(call):
         CACHE['exit_departments'].clear()
         CACHE['exams'].clear()
         CACHE['exam_lists'].clear()
+        _rendered_questions.clear()
         load_cache()
         bot.edit_message_text("Cache cleared successfully.", call.from_user.id, call.message.message_id)
         
@@ -1235,12 +1527,20 @@ def admin_misc_callbacks(call):
         status = "ON" if MAINTENANCE_MODE else "OFF"
         bot.edit_message_text(f"Maintenance mode is now {status}.", call.from_user.id, call.message.message_id)
 
+# Telegram allows ~30 bulk messages per second; pace broadcast sends a
+# little under that so a big user list doesn't trip 429 retry-afters.
+BROADCAST_SEND_INTERVAL = 0.05
+
 def process_broadcast(message):
     bot.send_message(message.from_user.id, "Starting broadcast...")
+    # Run the send loop off the handler pool: a few thousand paced sends
+    # would otherwise pin one of the bot's worker threads for minutes.
+    threading.Thread(target=_run_broadcast, args=(message,), daemon=True).start()
+
+def _run_broadcast(message):
     success = 0
     try:
-        users = list(db.collection('users').stream())
-        for user_doc in users:
+        for user_doc in users_col().select(['__name__']).stream():
             uid = int(user_doc.id)
             if uid == ADMIN_TELEGRAM_ID:
                 continue
@@ -1255,6 +1555,7 @@ def process_broadcast(message):
                     success += 1
                 except Exception:
                     pass
+                time.sleep(BROADCAST_SEND_INTERVAL)
                     
         bot.send_message(message.from_user.id, f"Broadcast sent to {success} users immediately. Others queued.")
     except Exception as e:
@@ -1263,7 +1564,11 @@ def process_broadcast(message):
 # ==========================================
 # 11. BACKGROUND TASKS (SESSION EXPIRY & QUEUE)
 # ==========================================
+# How often the background worker refreshes the Firestore-backed caches.
+CACHE_REFRESH_INTERVAL = 10 * 60
+
 def background_worker():
+    last_cache_refresh = time.monotonic()
     while True:
         now = datetime.now()
         expired_users = []
@@ -1284,13 +1589,29 @@ def background_worker():
                     del queued_broadcasts[uid]
             except Exception:
                 pass
-                
-        time.sleep(60) 
+
+        # Periodically re-pull subjects/departments/ads so changes made
+        # outside this process (e.g. console edits) show up without a
+        # restart or a manual cache clear.
+        if time.monotonic() - last_cache_refresh > CACHE_REFRESH_INTERVAL:
+            last_cache_refresh = time.monotonic()
+            load_cache()
+
+        time.sleep(60)
 
 # ==========================================
 # 12. ENTRY POINT
 # ==========================================
 if __name__ == '__main__':
+    # Resolve the bot username once at startup if it isn't configured;
+    # referral deep links are built from this on every lock screen, and a
+    # get_me() round-trip there would be pure waste.
+    if not BOT_USERNAME:
+        try:
+            BOT_USERNAME = bot.get_me().username
+        except Exception as e:
+            print(f"Could not resolve bot username: {e}")
+
     load_cache()
     threading.Thread(target=run_flask, daemon=True).start()
     threading.Thread(target=background_worker, daemon=True).start()